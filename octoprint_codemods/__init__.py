@@ -1 +1,2 @@
 # octoprint_codemods
+from .util import FileResult, Finding, run_codemods  # noqa: F401
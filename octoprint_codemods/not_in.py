@@ -1,9 +1,9 @@
-from typing import Union, cast
+from typing import cast
 
 import libcst as cst
 import libcst.matchers as m
 
-from .util import CodeMod, runner
+from .util import CodeRule, runner
 
 """
 libcst based transformer to change 'not foo in bar' to 'foo not in bar' constructs.
@@ -13,37 +13,29 @@ __author__ = "Gina Häußge <gina@octoprint.org>"
 __license__ = "MIT"
 
 
-class NotIn(CodeMod):
+class NotIn(CodeRule):
     COMMAND: str = "not_in"
     DESCRIPTION: str = "Converts 'not foo in bar' to 'foo not in bar' constructs."
 
-    def leave_UnaryOperation(
-        self, node: cst.UnaryOperation, updated_node: cst.UnaryOperation
-    ) -> Union[cst.UnaryOperation, cst.Comparison]:
-        if m.matches(
-            updated_node,
-            m.UnaryOperation(
-                operator=m.Not(),
-                expression=m.Comparison(
-                    comparisons=[m.ComparisonTarget(operator=m.In())]
-                ),
-            ),
-        ):
-            expression = cast(cst.Comparison, updated_node.expression)
-            new_node = cst.Comparison(
-                left=expression.left,
-                comparisons=[
-                    cst.ComparisonTarget(
-                        operator=cst.NotIn(),
-                        comparator=expression.comparisons[0].comparator,
-                    )
-                ],
-            )
-
-            self._report_node(node)
-            self.count += 1
-            return new_node
-        return updated_node
+    TOKEN = "not"
+    PATTERN = m.UnaryOperation(
+        operator=m.Not(),
+        expression=m.Comparison(comparisons=[m.ComparisonTarget(operator=m.In())]),
+    )
+
+    def replace(
+        self, original_node: cst.UnaryOperation, updated_node: cst.UnaryOperation
+    ) -> cst.Comparison:
+        expression = cast(cst.Comparison, updated_node.expression)
+        return cst.Comparison(
+            left=expression.left,
+            comparisons=[
+                cst.ComparisonTarget(
+                    operator=cst.NotIn(),
+                    comparator=expression.comparisons[0].comparator,
+                )
+            ],
+        )
 
 
 def main():
@@ -16,6 +16,7 @@ __license__ = "MIT"
 class CheckBuiltinsImports(CodeMod):
     COMMAND: str = "remove_builtins_imports"
     DESCRIPTION: str = "Removes 'from builtins import ...' and 'import builtins'"
+    IMPORTS_ONLY: bool = True
 
     def leave_Import(
         self, node: cst.Import, updated_node: cst.Import
@@ -42,32 +42,32 @@ class RemoveFloatConversion(CodeMod):
     def leave_BinaryOperation(
         self, original_node: cst.BinaryOperation, updated_node: cst.BinaryOperation
     ) -> cst.BinaryOperation:
-        changed = False
-
-        if m.matches(
+        # replacing one argument doesn't change whether the other one matches
+        left = m.matches(
             updated_node,
             m.BinaryOperation(operator=self.TARGET_OPERATOR, left=self.TARGET_ARGUMENT),
-        ):
-            # left arg
+        )
+        right = m.matches(
+            updated_node,
+            m.BinaryOperation(operator=self.TARGET_OPERATOR, right=self.TARGET_ARGUMENT),
+        )
+
+        if not left and not right:
+            return updated_node
+
+        self._report_node(original_node)
+        self.count += 1
+        if self.check_only:
+            return updated_node
+
+        if left:
             updated_node = updated_node.with_changes(
                 left=self._replace_arg(updated_node.left)
             )
-            changed = True
-
-        if m.matches(
-            updated_node,
-            m.BinaryOperation(operator=self.TARGET_OPERATOR, right=self.TARGET_ARGUMENT),
-        ):
-            # right arg
+        if right:
             updated_node = updated_node.with_changes(
                 right=self._replace_arg(updated_node.right)
             )
-            changed = True
-
-        if changed:
-            self._report_node(original_node)
-            self.count += 1
-
         return updated_node
 
     def leave_AugAssign(
@@ -79,6 +79,8 @@ class RemoveFloatConversion(CodeMod):
         ):
             self._report_node(original_node)
             self.count += 1
+            if self.check_only:
+                return updated_node
             return updated_node.with_changes(value=self._replace_arg(updated_node.value))
 
         return updated_node
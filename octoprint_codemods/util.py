@@ -1,15 +1,39 @@
 import argparse
+import ast
 import difflib
+import hashlib
+import io
+import json
 import os
 import re
+import subprocess
 import sys
-from abc import ABCMeta
-from contextlib import ExitStack
-from typing import Callable, ClassVar, Iterable, List, Optional, Tuple, Type, Union, cast
+import time
+import tokenize
+from abc import ABCMeta, abstractmethod
+from contextlib import ExitStack, redirect_stdout
+from typing import (
+    BinaryIO,
+    Callable,
+    ClassVar,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 
 import libcst as cst
+import libcst.matchers as m
 from libcst._batched_visitor import _get_visitor_methods, _VisitorMethodCollection
-from libcst.metadata import PositionProvider
+from libcst.metadata import CodePosition, CodeRange, PositionProvider
 
 
 class BatchedCSTTranformer(cst.CSTTransformer):
@@ -49,7 +73,7 @@ class BatchedCSTTranformer(cst.CSTTransformer):
         type_name = type(original_node).__name__
 
         for v in self._get_visitor_methods(f"leave_{type_name}"):
-            v(updated_node)
+            v(original_node)
         for v in self._get_transformer_methods(f"leave_{type_name}"):
             updated_node = v(original_node, updated_node)
 
@@ -92,20 +116,85 @@ class BatchedCSTTranformer(cst.CSTTransformer):
         return self._get_methods(method_name, incl_visitors=False, incl_transformers=True)
 
 
+class BatchedCSTChecker(BatchedCSTTranformer):
+    """
+    Internal visitor class to perform batched traversal over a tree without
+    transforming it.
+
+    Transformers are driven like visitors: their leave methods get passed the
+    original node as updated node and their results are discarded.
+    """
+
+    def on_leave(
+        self, original_node: cst.CSTNode, updated_node: cst.CSTNode
+    ) -> cst.CSTNode:
+        """
+        Call appropriate leave methods on node after visiting children.
+        """
+        type_name = type(original_node).__name__
+
+        for v in self._get_visitor_methods(f"leave_{type_name}"):
+            v(original_node)
+        for v in self._get_transformer_methods(f"leave_{type_name}"):
+            v(original_node, original_node)
+
+        return original_node
+
+
+Dispatch = Tuple[_VisitorMethodCollection, _VisitorMethodCollection]
+
+
+def get_dispatch(
+    inspectors: Iterable[Union[cst.CSTVisitor, cst.CSTTransformer]]
+) -> Dispatch:
+    """
+    Collects the visitor and transformer methods of the inspectors for batched
+    traversal.
+
+    Inspectors are reused across files, so this only needs to be done once per run,
+    the result can then be passed along for every file.
+    """
+    inspectors = list(inspectors)
+    visitors = [t for t in inspectors if isinstance(t, cst.CSTVisitor)]
+    transformers = [t for t in inspectors if isinstance(t, cst.CSTTransformer)]
+    rules = compile_rules(t for t in transformers if isinstance(t, CodeRule))
+
+    # keep the order of the inspectors, compiled rules go where their first rule is
+    transformer_methods: Dict[str, List[Callable]] = {}
+    for transformer in transformers:
+        if isinstance(transformer, CodeRule):
+            name = f"leave_{transformer.node_type().__name__}"
+            if name in rules:
+                transformer_methods.setdefault(name, []).append(rules.pop(name))
+        else:
+            for name, methods in _get_visitor_methods([transformer]).items():
+                transformer_methods.setdefault(name, []).extend(methods)
+
+    return _get_visitor_methods(visitors), transformer_methods
+
+
 def transform_batched(
     node: cst.CSTNodeT,
     inspectors: Iterable[Union[cst.CSTVisitor, cst.CSTTransformer]],
+    dispatch: Optional[Dispatch] = None,
 ) -> cst.CSTNodeT:
-    visitors = [t for t in inspectors if isinstance(t, cst.CSTVisitor)]
-    transformers = [t for t in inspectors if isinstance(t, cst.CSTTransformer)]
-
-    visitor_methods = _get_visitor_methods(visitors)
-    transformer_methods = _get_visitor_methods(transformers)
+    visitor_methods, transformer_methods = dispatch or get_dispatch(inspectors)
 
     batched_transformer = BatchedCSTTranformer(visitor_methods, transformer_methods)
     return cast(cst.CSTNodeT, node.visit(batched_transformer))
 
 
+def check_batched(
+    node: cst.CSTNode,
+    inspectors: Iterable[Union[cst.CSTVisitor, cst.CSTTransformer]],
+    dispatch: Optional[Dispatch] = None,
+) -> None:
+    visitor_methods, transformer_methods = dispatch or get_dispatch(inspectors)
+
+    batched_checker = BatchedCSTChecker(visitor_methods, transformer_methods)
+    node.visit(batched_checker)
+
+
 class CodeInspectorMeta(ABCMeta):
     registry = {}
 
@@ -125,15 +214,103 @@ class CodeInspectorMeta(ABCMeta):
         return list(cls.registry.keys())
 
 
+class Finding:
+    """
+    A single node reported by an inspector.
+
+    The message is stored as a template with a placeholder for the filename, so the
+    finding can be carried over to other files with identical contents.
+    """
+
+    FILENAME_PLACEHOLDER: ClassVar[str] = "\0filename\0"
+
+    __slots__ = ("command", "filename", "line", "column", "code", "template")
+
+    def __init__(
+        self,
+        command: str,
+        filename: str,
+        line: int,
+        column: int,
+        code: str,
+        template: str,
+    ) -> None:
+        self.command = command
+        self.filename = filename
+        self.line = line
+        self.column = column
+        self.code = code
+        self.template = template
+
+    @property
+    def message(self) -> str:
+        return self.template.replace(self.FILENAME_PLACEHOLDER, self.filename)
+
+    def for_file(self, filename: str) -> "Finding":
+        return Finding(
+            self.command, filename, self.line, self.column, self.code, self.template
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Finding({self.command!r}, {self.filename!r}, "
+            f"line={self.line}, column={self.column})"
+        )
+
+
+class FileResult:
+    """
+    The result of running inspectors on a single file.
+
+    ``source`` holds the (possibly transformed) source, or None if the file was only
+    checked or could not be processed, in which case ``error`` says why.
+    """
+
+    __slots__ = ("filename", "counts", "findings", "source", "modified", "error")
+
+    def __init__(
+        self,
+        filename: str,
+        counts: Optional[Dict[str, int]] = None,
+        findings: Optional[List[Finding]] = None,
+        source: Optional[str] = None,
+        modified: bool = False,
+        error: Optional[str] = None,
+    ) -> None:
+        self.filename = filename
+        self.counts = counts if counts is not None else {}
+        self.findings = findings if findings is not None else []
+        self.source = source
+        self.modified = modified
+        self.error = error
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def __repr__(self) -> str:
+        return f"FileResult({self.filename!r}, count={self.count})"
+
+
 class CodeInspector(cst.MetadataDependent, metaclass=CodeInspectorMeta):
     METADATA_DEPENDENCIES = (PositionProvider,)
     COMMAND: ClassVar[str]
     DESCRIPTION: ClassVar[str]
 
+    # set to True if the inspector only ever looks at Import and ImportFrom nodes,
+    # allows the runner to only parse the file's import statements
+    IMPORTS_ONLY: ClassVar[bool] = False
+
     args: argparse.Namespace
     count: int
     filename: str
     module: cst.Module
+    findings: List[Finding]
+    source_index: Optional["SourceIndex"]
+
+    # set while only checking, mods should then only report and count what they
+    # would change and not bother building any replacement nodes
+    check_only: bool
 
     @classmethod
     def add_parser_args(cls, parser):
@@ -148,31 +325,55 @@ class CodeInspector(cst.MetadataDependent, metaclass=CodeInspectorMeta):
         self,
         filename: Union[str, None] = None,
         module: Union[cst.Module, None] = None,
+        findings: Union[List[Finding], None] = None,
+        check_only: bool = False,
+        source_index: Union["SourceIndex", None] = None,
     ) -> None:
         self.count = 0
         self.filename = filename.replace("\\", "/") if filename else filename
         self.module = module
+        self.findings = findings if findings is not None else []
+        self.check_only = check_only
+        self.source_index = source_index
+
+    def _code_for_node(self, node: cst.CSTNode, code_range: CodeRange) -> str:
+        if self.source_index:
+            code = self.source_index.code_for_node(node, code_range)
+        elif self.module:
+            code = self.module.code_for_node(node)
+        else:
+            return ""
+
+        max_lines = getattr(self.args, "snippet_lines", None)
+        if max_lines:
+            lines = code.split("\n")
+            if len(lines) > max_lines:
+                code = "\n".join(lines[:max_lines] + ["..."])
+        return code
 
     def _report_node(
         self,
         node: cst.CSTNode,
         output: str = "{filename}:{pos.line}:{pos.column}:\n{code}",
     ) -> None:
-        if self.get_metadata(PositionProvider, node):
-            pos = self.get_metadata(PositionProvider, node).start
-            print(
-                output.format(
-                    node=node,
-                    pos=pos,
-                    code="\n".join(
-                        map(
-                            lambda x: "  " + x,
-                            (
-                                self.module.code_for_node(node) if self.module else ""
-                            ).split("\n"),
-                        )
+        code_range = self.get_metadata(PositionProvider, node)
+        if code_range:
+            pos = code_range.start
+            code = self._code_for_node(node, code_range)
+            filename = self.filename if self.filename else ""
+            self.findings.append(
+                Finding(
+                    command=getattr(self, "COMMAND", type(self).__name__),
+                    filename=filename,
+                    line=pos.line,
+                    column=pos.column,
+                    code=code,
+                    template=output.format(
+                        node=node,
+                        pos=pos,
+                        code="\n".join(map(lambda x: "  " + x, code.split("\n"))),
+                        filename=Finding.FILENAME_PLACEHOLDER,
                     ),
-                    filename=self.filename if self.filename else "",
                 )
             )
 
@@ -185,53 +386,447 @@ class CodeCheck(CodeInspector, cst.CSTVisitor, cst.BatchableCSTVisitor):
     pass
 
 
+class CodeRule(CodeMod):
+    """
+    Declarative mod that replaces all nodes matching ``PATTERN`` with whatever
+    ``replace`` builds for them.
+
+    Rules don't implement any visitor methods themselves. Instead, all selected rules
+    are compiled into a single leave method per node type (see ``compile_rules``).
+    Only the first selected rule that matches a node is applied to it, so overlapping
+    rules are counted the same way in check-only mode as in a real run. Relative to
+    other mods, the rules for a node type run where the first of them was selected.
+    If ``TOKEN`` is set, the rule is skipped for files whose source doesn't contain
+    it. ``NODE`` is derived from the pattern unless that isn't a plain node matcher.
+    """
+
+    PATTERN: ClassVar[m.BaseMatcherNode]
+    TOKEN: ClassVar[Optional[str]] = None
+    NODE: ClassVar[Optional[Type[cst.CSTNode]]] = None
+
+    enabled: bool
+
+    @classmethod
+    def node_type(cls) -> Type[cst.CSTNode]:
+        if cls.NODE:
+            return cls.NODE
+
+        node_type = getattr(cst, type(cls.PATTERN).__name__, None)
+        if not isinstance(node_type, type) or not issubclass(node_type, cst.CSTNode):
+            raise TypeError(f"Can't derive node type of rule {cls.__name__}, set NODE")
+        return node_type
+
+    def reset(self, *args, **kwargs) -> None:
+        super().reset(*args, **kwargs)
+        self.enabled = (
+            not self.TOKEN
+            or self.source_index is None
+            or self.TOKEN in self.source_index.source
+        )
+
+    @abstractmethod
+    def replace(
+        self, original_node: cst.CSTNode, updated_node: cst.CSTNode
+    ) -> Union[cst.CSTNode, cst.RemovalSentinel]:
+        ...
+
+
+def compile_rules(rules: Iterable[CodeRule]) -> Dict[str, Callable]:
+    """
+    Compiles the rules into one leave method per node type, which applies the first
+    matching rule for that node type.
+    """
+    by_type: Dict[Type[cst.CSTNode], List[CodeRule]] = {}
+    for rule in rules:
+        by_type.setdefault(rule.node_type(), []).append(rule)
+
+    def dispatcher(rules: List[CodeRule]) -> Callable:
+        patterns = [(rule, rule.PATTERN) for rule in rules]
+
+        def leave(
+            original_node: cst.CSTNode, updated_node: cst.CSTNode
+        ) -> Union[cst.CSTNode, cst.RemovalSentinel]:
+            for rule, pattern in patterns:
+                if not rule.enabled or not m.matches(updated_node, pattern):
+                    continue
+
+                rule._report_node(original_node)
+                rule.count += 1
+                if not rule.check_only:
+                    updated_node = rule.replace(original_node, updated_node)
+                break
+            return updated_node
+
+        return leave
+
+    return {
+        f"leave_{node_type.__name__}": dispatcher(rules)
+        for node_type, rules in by_type.items()
+    }
+
+
 class TransformError(Exception):
     """Error raise while encountering a known error while attempting to transform the tree"""
 
 
-def process_file(
+class ImportHeaderWrapper(cst.MetadataWrapper):
+    """
+    Metadata wrapper around a module synthesized from just the import statements of
+    a file (see ``scan_import_statements``), mapping positions back onto the original
+    file.
+    """
+
+    def __init__(self, module: cst.Module, column_offsets: Mapping[int, int]) -> None:
+        super().__init__(module, unsafe_skip_copy=True)
+        self.column_offsets = column_offsets
+
+    def _shift(self, pos: CodePosition) -> CodePosition:
+        offset = self.column_offsets.get(pos.line, 0)
+        return CodePosition(pos.line, pos.column + offset) if offset else pos
+
+    def resolve_many(
+        self, providers: Collection[Type[cst.BaseMetadataProvider]]
+    ) -> Mapping[Type[cst.BaseMetadataProvider], Mapping[cst.CSTNode, object]]:
+        metadata = dict(super().resolve_many(providers))
+        if PositionProvider in metadata:
+            metadata[PositionProvider] = {
+                node: CodeRange(self._shift(pos.start), self._shift(pos.end))
+                for node, pos in metadata[PositionProvider].items()
+            }
+        return metadata
+
+
+class SourceIndex:
+    """
+    Line offset index over the original source of a file, to get the code of
+    reported nodes by slicing the source instead of regenerating it.
+    """
+
+    NEWLINE_RE = re.compile(r"\r\n?|\n")
+    INDENTED_CONTINUATION_RE = re.compile(r"(?:\r\n?|\n)[ \t\f]")
+
+    def __init__(self, source: str, module: cst.Module) -> None:
+        self.source = source
+        self.module = module
+        self._line_offsets: Optional[List[int]] = None
+
+    def _offset(self, pos: CodePosition) -> int:
+        if self._line_offsets is None:
+            # only needed for files with findings, so built on first use
+            self._line_offsets = [0] + [
+                match.end() for match in self.NEWLINE_RE.finditer(self.source)
+            ]
+        return self._line_offsets[pos.line - 1] + pos.column
+
+    def code_for_node(self, node: cst.CSTNode, code_range: CodeRange) -> str:
+        """
+        Returns the code of the node, given its range from the PositionProvider.
+
+        Only expressions and small statements are sliced, parentheses, commas and
+        semicolons owned by them lie outside of that range and are added back. Other
+        nodes own whitespace around them and code generation also drops the indentation
+        of enclosing blocks from indented continuation lines, so in those cases the code
+        is still regenerated.
+        """
+        if not isinstance(node, (cst.BaseExpression, cst.BaseSmallStatement)):
+            return self.module.code_for_node(node)
+
+        code = self.source[self._offset(code_range.start) : self._offset(code_range.end)]
+        if self.INDENTED_CONTINUATION_RE.search(code):
+            return self.module.code_for_node(node)
+
+        if isinstance(node, cst.BaseExpression):
+            code = (
+                "".join(self.module.code_for_node(lpar) for lpar in node.lpar)
+                + code
+                + "".join(self.module.code_for_node(rpar) for rpar in node.rpar)
+            )
+            comma = getattr(node, "comma", None)
+            if isinstance(comma, cst.Comma):
+                code += self.module.code_for_node(comma)
+        elif isinstance(node.semicolon, cst.Semicolon):
+            code += self.module.code_for_node(node.semicolon)
+
+        return code
+
+
+def scan_import_statements(source: str) -> Tuple[str, Dict[int, int]]:
+    """
+    Extracts all import statements from the source, including those nested in
+    compound statements like ``try`` or ``if``, using a tokenize based scan.
+
+    Returns a module source that contains only the (dedented) import statements on
+    their original lines and a mapping of line number to the column offset of the
+    code on that line. Anything following an import on the same logical line is kept
+    as well.
+
+    Like libcst's code generation for nested nodes, continuation lines within brackets
+    lose the indentation of the enclosing block.
+    """
+    lines = io.StringIO(source).readlines()
+    header = ["\n"] * len(lines)
+    column_offsets: Dict[int, int] = {}
+
+    def extract(
+        start: Tuple[int, int], end: Tuple[int, int], indent: str, bracket_rows: Set[int]
+    ) -> None:
+        (start_row, start_col), (end_row, end_col) = start, end
+        code = []
+        for row in range(start_row, end_row + 1):
+            line = lines[row - 1]
+            if row == end_row:
+                line = line[:end_col]
+
+            offset = 0
+            if row == start_row:
+                offset = start_col
+            elif row in bracket_rows and indent and line.startswith(indent):
+                offset = len(indent)
+
+            if offset:
+                line = line[offset:]
+                column_offsets[row] = offset
+            code.append(line)
+
+        header[start_row - 1] = "".join(code) + "\n"
+        for row in range(start_row, end_row):
+            header[row] = ""
+
+    start = None
+    statement_start = True
+    depth = 0
+    indents = [""]
+    row = 0
+    bracket_rows: Set[int] = set()
+    for token in tokenize.generate_tokens(io.StringIO(source).readline):
+        if start and depth > 0 and token.start[0] > row:
+            # first token on a continuation line within brackets
+            bracket_rows.add(token.start[0])
+        row = token.end[0]
+
+        if token.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+            if start:
+                extract(start, token.start, indents[-1], bracket_rows)
+            start = None
+            statement_start = True
+            continue
+
+        if token.type == tokenize.INDENT:
+            indents.append(token.string)
+            continue
+        elif token.type == tokenize.DEDENT:
+            indents.pop()
+            continue
+        elif token.type in (tokenize.NL, tokenize.COMMENT):
+            continue
+
+        if token.type == tokenize.OP:
+            if token.string in "([{":
+                depth += 1
+            elif token.string in ")]}":
+                depth -= 1
+            elif depth == 0 and token.string in (";", ":"):
+                # a new simple statement might follow
+                statement_start = True
+                continue
+
+        elif (
+            statement_start
+            and start is None
+            and token.type == tokenize.NAME
+            and token.string in ("import", "from")
+        ):
+            start = token.start
+            bracket_rows = set()
+
+        statement_start = False
+
+    return "".join(header), column_offsets
+
+
+def parse_import_header(source: str) -> ImportHeaderWrapper:
+    """
+    Parses only the import statements of the source, see ``scan_import_statements``.
+    """
+    header, column_offsets = scan_import_statements(source)
+    return ImportHeaderWrapper(cst.parse_module(header), column_offsets)
+
+
+def _visit_tree(
+    visitors: Iterable[Union[CodeMod, CodeCheck]],
+    filename: str,
+    source_tree: cst.MetadataWrapper,
+    python_source: str,
+    findings: List[Finding],
+    check_only: bool = False,
+    dispatch: Optional[Dispatch] = None,
+) -> Optional[cst.Module]:
+    source_index = SourceIndex(python_source, source_tree.module)
+    for v in visitors:
+        v.reset(
+            filename=filename,
+            module=source_tree.module,
+            findings=findings,
+            check_only=check_only,
+            source_index=source_index,
+        )
+
+    with ExitStack() as stack:
+        # Resolve dependencies of visitors
+        for v in visitors:
+            stack.enter_context(v.resolve(source_tree))
+
+        if check_only:
+            check_batched(source_tree.module, visitors, dispatch=dispatch)
+            return None
+
+        return transform_batched(source_tree.module, visitors, dispatch=dispatch)
+
+
+def _counts(visitors: Iterable[Union[CodeMod, CodeCheck]]) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for v in visitors:
+        command = getattr(v, "COMMAND", type(v).__name__)
+        counts[command] = counts.get(command, 0) + v.count
+    return counts
+
+
+def _process_import_header(
+    visitors: Iterable[Union[CodeMod, CodeCheck]],
+    filename: str,
+    python_source: str,
+    check_only: bool = False,
+    dispatch: Optional[Dispatch] = None,
+) -> Optional[FileResult]:
+    """
+    Runs import-only visitors on just the import statements of the source.
+
+    Returns None if the full module needs to be processed instead, either because
+    the header couldn't be processed or because a mod wants to rewrite the file
+    (and we are not only checking).
+    """
+    try:
+        # the import statements alone don't tell whether the whole file parses
+        compile(python_source, filename, "exec", ast.PyCF_ONLY_AST)
+        source_tree = parse_import_header(python_source)
+    except Exception:
+        # let the full parse report any errors
+        return None
+
+    findings: List[Finding] = []
+    try:
+        _visit_tree(
+            visitors,
+            filename,
+            source_tree,
+            python_source,
+            findings,
+            check_only=check_only,
+            dispatch=dispatch,
+        )
+    except TransformError:
+        return None
+
+    modified = any(isinstance(v, CodeMod) and v.count for v in visitors)
+    if check_only:
+        return FileResult(
+            filename, counts=_counts(visitors), findings=findings, modified=modified
+        )
+    elif modified:
+        return None
+
+    # nothing to rewrite, so the source stays as it is
+    return FileResult(
+        filename, counts=_counts(visitors), findings=findings, source=python_source
+    )
+
+
+def inspect_file(
     visitors: Iterable[Union[CodeMod, CodeCheck]],
     filename: str,
     write_before: bool = False,
     write_after: bool = False,
     write_result: bool = True,
-) -> None:
+    check_only: bool = False,
+    dispatch: Optional[Dispatch] = None,
+) -> FileResult:
+    """
+    Runs the visitors on the file and returns the result, without printing anything.
+
+    If check_only is set, mods only report and count what they would change, the
+    tree is neither transformed nor written back and the result carries no source.
+    The dispatch of the visitors (see ``get_dispatch``) can be passed in when
+    processing several files with the same visitors.
+    """
+    # don't carry over counts from the previous file if this one can't be processed
+    for v in visitors:
+        v.reset(filename=filename)
+
     try:
         with open(filename, "r") as python_file:
             python_source = python_file.read()
     except Exception as exc:
-        print("Could not read file {}, skipping: {}".format(filename, str(exc)))
+        return FileResult(
+            filename,
+            counts=_counts(visitors),
+            error="Could not read file {}, skipping: {}".format(filename, str(exc)),
+        )
+
+    if not write_before and not write_after and all(v.IMPORTS_ONLY for v in visitors):
+        result = _process_import_header(
+            visitors, filename, python_source, check_only=check_only, dispatch=dispatch
+        )
+        if result:
+            return result
 
     try:
         module = cst.parse_module(python_source)
         source_tree = cst.MetadataWrapper(module)
     except Exception as e:
-        print("{} failed parse: {}".format(filename, str(e)))
-        return
+        return FileResult(
+            filename,
+            counts=_counts(visitors),
+            error="{} failed parse: {}".format(filename, str(e)),
+        )
 
     if write_before:
         with open(filename + ".cst.before", "w") as cst_file:
             cst_file.write(str(source_tree))
 
-    mod = False
-    for v in visitors:
-        v.reset(filename=filename, module=module)
-        mod = mod or isinstance(v, CodeMod)
+    mods = [v for v in visitors if isinstance(v, CodeMod)]
 
+    findings: List[Finding] = []
     try:
-        with ExitStack() as stack:
-            # Resolve dependencies of visitors
-            for v in visitors:
-                stack.enter_context(v.resolve(source_tree))
-
-            visited_tree = transform_batched(source_tree.module, visitors)
+        visited_tree = _visit_tree(
+            visitors,
+            filename,
+            source_tree,
+            python_source,
+            findings,
+            check_only=check_only,
+            dispatch=dispatch,
+        )
 
     except TransformError as e:
-        print("{} failed transform: {}".format(filename, str(e)))
-        return
+        return FileResult(
+            filename,
+            counts=_counts(visitors),
+            findings=findings,
+            error="{} failed transform: {}".format(filename, str(e)),
+        )
+
+    if check_only:
+        return FileResult(
+            filename,
+            counts=_counts(visitors),
+            findings=findings,
+            modified=any(v.count for v in mods),
+        )
 
-    if mod:
-        if v.count:
+    modified = False
+    if mods:
+        if any(v.count for v in mods):
+            modified = True
             if write_result:
                 with open(filename, "w") as python_file:
                     python_file.write(visited_tree.code)
@@ -240,7 +835,84 @@ def process_file(
             with open(filename + ".cst.after", "w") as cst_file:
                 cst_file.write(str(visited_tree))
 
-    return visited_tree.code
+    return FileResult(
+        filename,
+        counts=_counts(visitors),
+        findings=findings,
+        source=visited_tree.code,
+        modified=modified,
+    )
+
+
+def report_result(result: FileResult) -> None:
+    """
+    Prints the findings and errors of a result.
+    """
+    for finding in result.findings:
+        print(finding.message)
+    if result.error:
+        print(result.error)
+
+
+def report_skipped(skipped: Iterable[Tuple[str, str]]) -> None:
+    """
+    Prints a summary of the files that were skipped and why.
+    """
+    skipped = list(skipped)
+    if skipped:
+        print(f"Skipped {len(skipped)} file(s):")
+        for python_file, reason in skipped:
+            print(f"  {python_file}: {reason}")
+
+
+def process_file(
+    visitors: Iterable[Union[CodeMod, CodeCheck]],
+    filename: str,
+    write_before: bool = False,
+    write_after: bool = False,
+    write_result: bool = True,
+) -> Optional[str]:
+    result = inspect_file(
+        visitors,
+        filename,
+        write_before=write_before,
+        write_after=write_after,
+        write_result=write_result,
+    )
+    report_result(result)
+    return result.source
+
+
+def fingerprint_file(filename: str) -> Optional[str]:
+    """
+    Returns a fingerprint of the file's contents, or None if it can't be read.
+    """
+    try:
+        with open(filename, "rb") as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except OSError:
+        return None
+
+
+def apply_result(
+    result: FileResult, filename: str, write_result: bool = True
+) -> FileResult:
+    """
+    Applies the result of processing one file to another file with identical
+    contents, writing back the transformed source if needed.
+    """
+    normalized = filename.replace("\\", "/")
+    if result.modified and write_result:
+        with open(filename, "w") as python_file:
+            python_file.write(result.source)
+
+    return FileResult(
+        filename,
+        counts=dict(result.counts),
+        findings=[finding.for_file(normalized) for finding in result.findings],
+        source=result.source,
+        modified=result.modified,
+    )
 
 
 def collect_files(base: str, ignored: List[str]) -> Tuple[str, ...]:
@@ -273,6 +945,226 @@ def collect_files(base: str, ignored: List[str]) -> Tuple[str, ...]:
     return tuple()
 
 
+def read_file_list(stream: BinaryIO, separator: bytes = b"\n") -> Iterator[str]:
+    """
+    Lazily reads the paths from a file list, separated by newlines or NUL bytes.
+    """
+    # read1 returns whatever is available instead of waiting for a full chunk
+    read = getattr(stream, "read1", stream.read)
+
+    rest = b""
+    while True:
+        chunk = read(64 * 1024)
+        if not chunk:
+            break
+
+        entries = (rest + chunk).split(separator)
+        rest = entries.pop()
+        for entry in entries:
+            if separator == b"\n":
+                entry = entry.rstrip(b"\r")
+            if entry:
+                yield os.fsdecode(entry)
+
+    if rest:
+        yield os.fsdecode(rest)
+
+
+def iter_files(
+    bases: Iterable[str],
+    ignored: List[str],
+    files_from: Optional[str] = None,
+    separator: bytes = b"\n",
+) -> Iterator[str]:
+    """
+    Yields all python files under the bases and the paths read from files_from
+    (a file or ``-`` for stdin), each only once.
+    """
+
+    def paths() -> Iterator[str]:
+        yield from bases
+
+        if files_from == "-":
+            yield from read_file_list(sys.stdin.buffer, separator)
+        elif files_from:
+            with open(files_from, "rb") as f:
+                yield from read_file_list(f, separator)
+
+    seen = set()
+    for path in paths():
+        for python_file in collect_files(path, ignored=ignored):
+            key = os.path.normpath(python_file)
+            if key not in seen:
+                seen.add(key)
+                yield python_file
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+def _git_changes(paths: Iterable[str], max_commits: int = 200) -> Dict[str, int]:
+    """
+    Ranks the paths by how recently they were changed in git: uncommitted changes
+    first, then by the most recent of the last max_commits commits touching them.
+    Paths without changes are not included.
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git"] + list(args),
+            cwd=os.path.dirname(os.path.abspath(paths[0])),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            universal_newlines=True,
+        ).stdout
+
+    root = git("rev-parse", "--show-toplevel").strip()
+    changed = []
+    entries = iter(
+        git("status", "--porcelain", "-z", "--untracked-files=all").split("\0")
+    )
+    for entry in entries:
+        if len(entry) > 3:
+            changed.append(entry[3:])
+            if entry[0] in "RC":
+                # skip the original path of renames and copies
+                next(entries, None)
+    log = git("log", f"-n{max_commits}", "--format=", "--name-only")
+
+    ranks: Dict[str, int] = {}
+    for rank, path in enumerate(changed + log.splitlines()):
+        if path:
+            ranks.setdefault(os.path.normcase(os.path.join(root, path)), rank)
+
+    result = {}
+    for path in paths:
+        rank = ranks.get(os.path.normcase(os.path.realpath(path)))
+        if rank is not None:
+            result[path] = 0 if rank < len(changed) else rank
+    return result
+
+
+def order_files(python_files: Iterable[str], order: str) -> List[str]:
+    """
+    Orders the files so that those most likely to contain new findings come first,
+    either by most recent modification time (``mtime``) or by most recent change
+    in git (``git``, falling back to ``mtime`` outside of git repositories).
+    """
+    python_files = list(python_files)
+    by_mtime = sorted(python_files, key=lambda x: -_mtime(x))
+    if order == "mtime":
+        return by_mtime
+
+    try:
+        ranks = _git_changes(python_files)
+    except (OSError, subprocess.CalledProcessError):
+        return by_mtime
+
+    return sorted(by_mtime, key=lambda x: ranks.get(x, float("inf")))
+
+
+def shard_spec(value: str) -> Tuple[int, int]:
+    """
+    Parses a shard specification ``I/N`` into a tuple, with ``1 <= I <= N``.
+    """
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected I/N")
+
+    index, total = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= total:
+        raise argparse.ArgumentTypeError(
+            f"invalid shard {value!r}, I must be between 1 and N"
+        )
+    return index, total
+
+
+def shard_files(python_files: Iterable[str], index: int, total: int) -> List[str]:
+    """
+    Deterministically partitions the files into ``total`` shards of about the same
+    size and returns the files of shard ``index`` (1-based), in their original order.
+
+    Files are assigned largest first to the currently smallest shard (longest
+    processing time first), ties are broken by path and shard index.
+    """
+    python_files = list(dict.fromkeys(python_files))
+
+    def file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    sizes = {path: file_size(path) for path in python_files}
+    loads = [0] * total
+    assigned = set()
+    for path in sorted(python_files, key=lambda x: (-sizes[x], x.replace("\\", "/"))):
+        shard = min(range(total), key=lambda x: (loads[x], x))
+        loads[shard] += sizes[path]
+        if shard == index - 1:
+            assigned.add(path)
+
+    return [path for path in python_files if path in assigned]
+
+
+def merge_results(result_files: Iterable[str]) -> int:
+    """
+    Merges the result files written by sharded runs, prints the combined report
+    and returns the combined count, or -1 if results of a shard are missing or
+    duplicated, the files are from runs with different numbers of shards or files
+    were skipped.
+    """
+    shards = set()
+    total = None
+    complete = True
+    results = []
+    skipped = []
+    for result_file in result_files:
+        with open(result_file, "r") as f:
+            data = json.load(f)
+
+        index, shard_total = data["shard"]
+        if total is None:
+            total = shard_total
+        elif total != shard_total:
+            print(f"{result_file} is from a run with {shard_total} shards, not {total}")
+            complete = False
+        if index in shards:
+            print(f"{result_file} contains shard {index}/{shard_total} again, skipping")
+            complete = False
+            continue
+        shards.add(index)
+
+        results += data["files"]
+        skipped += data.get("skipped", [])
+
+    if total is not None:
+        missing = sorted(set(range(1, total + 1)) - shards)
+        if missing:
+            print(
+                "Missing results for shard(s) {}".format(
+                    ", ".join(f"{index}/{total}" for index in missing)
+                )
+            )
+            complete = False
+
+    count = 0
+    for result in sorted(results, key=lambda x: x["file"]):
+        sys.stdout.write(result["output"])
+        count += result["count"]
+
+    report_skipped(sorted(skipped))
+    return count if complete and not skipped else -1
+
+
 def parse_args(
     description: str, add_parser_args: Optional[Callable] = None
 ) -> argparse.Namespace:
@@ -280,9 +1172,21 @@ def parse_args(
     parser.add_argument(
         "bases",
         type=str,
-        nargs="+",
+        nargs="*",
         help="Files and directories (recursive) including python files to be modified.",
     )
+    parser.add_argument(
+        "--files-from",
+        type=str,
+        metavar="FILE",
+        help="Also process the files and directories listed in FILE (- for stdin), one per line",
+    )
+    parser.add_argument(
+        "-z",
+        "--null",
+        action="store_true",
+        help="Paths in the --files-from list are separated by NUL instead of newline characters",
+    )
     parser.add_argument(
         "--before",
         action="store_true",
@@ -298,6 +1202,11 @@ def parse_args(
         action="store_true",
         help="Only perform a dry run without writing back the transformed file",
     )
+    parser.add_argument(
+        "--check-only",
+        action="store_true",
+        help="Only report and count what would be changed, without transforming or writing back anything",
+    )
     parser.add_argument(
         "--ignore",
         type=str,
@@ -310,14 +1219,66 @@ def parse_args(
         action="store_true",
         help="Generate output for all processed files, not juse for those with replacements",
     )
+    parser.add_argument(
+        "--snippet-lines",
+        type=int,
+        metavar="N",
+        help="Truncate the code reported for each finding to N lines",
+    )
     parser.add_argument(
         "--test",
         action="store_true",
         help="Run in test mode: first path is input file, second path is file with expected output.",
     )
+    parser.add_argument(
+        "--shard",
+        type=shard_spec,
+        metavar="I/N",
+        help="Only process the I-th of N shards of the collected files, balanced by file size",
+    )
+    parser.add_argument(
+        "--shard-result",
+        type=str,
+        metavar="FILE",
+        help="File to write the results of a sharded run to, defaults to codemods-shard-I-of-N.json",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the result files of sharded runs passed as paths into one report",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        type=int,
+        nargs="?",
+        const=1,
+        metavar="N",
+        help="Stop processing further files once N (default: 1) findings have been reported",
+    )
+    parser.add_argument(
+        "--order",
+        choices=["path", "mtime", "git"],
+        default="path",
+        help="Order in which to process files: as collected, most recently modified first or most recently changed in git first",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and reprocess python files below the paths whenever they change",
+    )
+    parser.add_argument(
+        "--file-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Process each file in a supervised worker process, skipping files that take longer than SECONDS or crash the worker",
+    )
     if add_parser_args:
         add_parser_args(parser)
-    return parser.parse_args()
+
+    args = parser.parse_args()
+    if not args.bases and not args.files_from:
+        parser.error("at least one path or --files-from is required")
+    return args
 
 
 def test_runner(
@@ -349,6 +1310,147 @@ def test_runner(
     return True
 
 
+def _inspect_with_args(
+    inspectors: Iterable[Union[CodeMod, CodeCheck]],
+    python_file: str,
+    args: argparse.Namespace,
+    dispatch: Optional[Dispatch] = None,
+) -> FileResult:
+    return inspect_file(
+        inspectors,
+        python_file,
+        write_before=args.before,
+        write_after=args.after,
+        write_result=not args.dryrun,
+        check_only=args.check_only,
+        dispatch=dispatch,
+    )
+
+
+def _supervised_worker(
+    conn, classes: List[Type[CodeInspector]], args: argparse.Namespace
+) -> None:
+    _init_worker(classes, args)
+    while True:
+        try:
+            python_file = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            conn.send((_inspect_in_worker(python_file), None))
+        except Exception as exc:
+            conn.send((None, "{}: {}".format(type(exc).__name__, str(exc))))
+
+
+class FileSupervisor:
+    """
+    Processes files one by one in a worker process, which is killed if it takes longer
+    than timeout seconds for a file and replaced if it dies.
+
+    Files that couldn't be processed are recorded in skipped, together with the reason.
+    """
+
+    def __init__(
+        self, classes: List[Type[CodeInspector]], args: argparse.Namespace, timeout: float
+    ) -> None:
+        self.classes = classes
+        self.args = args
+        self.timeout = timeout
+        self.process = None
+        self.conn = None
+        self.skipped: List[Tuple[str, str]] = []
+
+    def _start(self) -> None:
+        import multiprocessing
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_supervised_worker,
+            args=(child_conn, self.classes, self.args),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def inspect(self, python_file: str) -> Optional[FileResult]:
+        """
+        Returns the result for the file, or None if it was skipped.
+        """
+        if self.process is None:
+            self._start()
+
+        start = time.monotonic()
+        try:
+            self.conn.send(python_file)
+            if self.conn.poll(self.timeout):
+                result, reason = self.conn.recv()
+                if result:
+                    return result
+            else:
+                reason = "timed out after {:g}s".format(self.timeout)
+                self.close()
+        except (EOFError, OSError):
+            self.process.join()
+            reason = "worker crashed with exit code {} after {:.1f}s".format(
+                self.process.exitcode, time.monotonic() - start
+            )
+            self.close()
+
+        self.skipped.append((python_file, reason))
+        return None
+
+    def close(self) -> None:
+        if self.process is None:
+            return
+
+        self.conn.close()
+        self.process.kill()
+        self.process.join()
+        self.process = None
+        self.conn = None
+
+
+def run_file(
+    inspectors: Iterable[Union[CodeMod, CodeCheck]],
+    python_file: str,
+    args: argparse.Namespace,
+    output: str,
+    duplicate_of: Optional[FileResult] = None,
+    supervisor: Optional[FileSupervisor] = None,
+    dispatch: Optional[Dispatch] = None,
+) -> FileResult:
+    """
+    Processes a single file as configured by args and reports the result.
+
+    If the file has the same contents as an already processed one, that one's result
+    can be passed as duplicate_of and is applied instead of processing the file again.
+    If a supervisor is passed, the file is processed in its worker process.
+    """
+    if duplicate_of:
+        result = apply_result(
+            duplicate_of,
+            python_file,
+            write_result=not args.dryrun and not args.check_only,
+        )
+    elif supervisor:
+        result = supervisor.inspect(python_file)
+        if result is None:
+            reason = supervisor.skipped[-1][1]
+            result = FileResult(
+                python_file,
+                counts={command: 0 for command in _counts(inspectors)},
+                error="{} skipped: {}".format(python_file, reason),
+            )
+    else:
+        result = _inspect_with_args(inspectors, python_file, args, dispatch=dispatch)
+    report_result(result)
+
+    if output and (args.verbose or result.count):
+        print(output.format(file=python_file.replace("\\", "/"), count=result.count))
+    return result
+
+
 def run(
     inspectors: Iterable[Union[CodeMod, CodeCheck]], args: argparse.Namespace, output: str
 ) -> int:
@@ -368,27 +1470,110 @@ def run(
             print("❌ Contents differ")
             sys.exit(-1)
 
+    if args.merge:
+        # merge mode
+        sys.exit(merge_results(args.bases))
+
+    if args.watch:
+        # watch mode
+        from .watch import watch
+
+        watch(inspectors, args, output)
+        sys.exit(0)
+
     # production mode
-    python_files: List[str] = []
-    for base in args.bases:
-        python_files += collect_files(base, ignored=args.ignore)
+    python_files: Iterable[str] = iter_files(
+        args.bases,
+        args.ignore,
+        files_from=args.files_from,
+        separator=b"\0" if args.null else b"\n",
+    )
+
+    if args.shard:
+        python_files = shard_files(python_files, *args.shard)
+
+    if args.order != "path":
+        python_files = order_files(python_files, args.order)
+
+    # files with identical contents only need to be processed once, unless
+    # per-file CST dumps are requested
+    dedupe = not args.before and not args.after
+    processed: Dict[str, FileResult] = {}
+
+    dispatch = get_dispatch(inspectors)
+    supervisor = None
+    if args.file_timeout:
+        supervisor = FileSupervisor(
+            [type(inspector) for inspector in inspectors], args, args.file_timeout
+        )
 
     count = 0
+    results = []
     for python_file in python_files:
-        process_file(
-            inspectors,
-            python_file,
-            write_before=args.before,
-            write_after=args.after,
-            write_result=not args.dryrun,
-        )
+        if args.fail_fast and count >= args.fail_fast:
+            print(f"Stopping after {count} findings, skipping remaining files")
+            break
 
-        file_count = sum([inspector.count for inspector in inspectors])
-        if output and (args.verbose or file_count):
-            print(output.format(file=python_file.replace("\\", "/"), count=file_count))
+        fingerprint = fingerprint_file(python_file) if dedupe else None
+
+        with ExitStack() as stack:
+            if args.shard:
+                file_output = stack.enter_context(redirect_stdout(io.StringIO()))
+
+            result = run_file(
+                inspectors,
+                python_file,
+                args,
+                output,
+                duplicate_of=processed.get(fingerprint) if fingerprint else None,
+                supervisor=supervisor,
+                dispatch=dispatch,
+            )
+            file_count = result.count
+
+        if fingerprint and fingerprint not in processed and result.error is None:
+            if not result.modified or args.dryrun or args.check_only:
+                # duplicates only need the source to write it back, don't keep the
+                # whole tree's text around otherwise
+                result.source = None
+            processed[fingerprint] = result
+
+        if args.shard:
+            sys.stdout.write(file_output.getvalue())
+            results.append(
+                {
+                    "file": python_file.replace("\\", "/"),
+                    "count": file_count,
+                    "output": file_output.getvalue(),
+                }
+            )
         count += file_count
 
-    sys.exit(count)
+    skipped: List[Tuple[str, str]] = []
+    if supervisor:
+        supervisor.close()
+        skipped = supervisor.skipped
+        report_skipped(skipped)
+
+    if args.shard:
+        index, total = args.shard
+        result_file = args.shard_result or f"codemods-shard-{index}-of-{total}.json"
+        with open(result_file, "w") as f:
+            json.dump(
+                {
+                    "shard": [index, total],
+                    "count": count,
+                    "files": results,
+                    "skipped": [
+                        [python_file.replace("\\", "/"), reason]
+                        for python_file, reason in skipped
+                    ],
+                },
+                f,
+            )
+
+    # files that were skipped haven't been checked, that mustn't pass as clean
+    sys.exit(-1 if skipped else count)
 
 
 def _load_all():
@@ -404,6 +1589,123 @@ def _load_all():
         importlib.import_module(f"octoprint_codemods.{module_name}")
 
 
+_worker_inspectors: List[Union[CodeMod, CodeCheck]] = []
+_worker_args: Optional[argparse.Namespace] = None
+_worker_dispatch: Optional[Dispatch] = None
+
+
+def _init_worker(classes: List[Type[CodeInspector]], args: argparse.Namespace) -> None:
+    global _worker_inspectors, _worker_args, _worker_dispatch
+    _worker_inspectors = [cls(args) for cls in classes]
+    _worker_args = args
+    _worker_dispatch = get_dispatch(_worker_inspectors)
+
+
+def _inspect_in_worker(python_file: str) -> FileResult:
+    return _inspect_with_args(
+        _worker_inspectors, python_file, _worker_args, dispatch=_worker_dispatch
+    )
+
+
+def _run_codemods(
+    python_files: List[str],
+    classes: List[Type[CodeInspector]],
+    args: argparse.Namespace,
+    jobs: int,
+) -> Iterator[FileResult]:
+    if jobs > 1 and len(python_files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(classes, args)
+        ) as executor:
+            futures = [
+                executor.submit(_inspect_in_worker, python_file)
+                for python_file in python_files
+            ]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                # if the caller stops early, don't bother with the remaining files
+                for future in futures:
+                    future.cancel()
+    else:
+        inspectors = [cls(args) for cls in classes]
+        dispatch = get_dispatch(inspectors)
+        for python_file in python_files:
+            yield _inspect_with_args(inspectors, python_file, args, dispatch=dispatch)
+
+
+def run_codemods(
+    paths: Iterable[str],
+    commands: Iterable[Union[str, Type[CodeInspector]]],
+    *,
+    write: bool = False,
+    check_only: bool = False,
+    jobs: Optional[int] = 1,
+    ignore: Iterable[str] = (),
+    **options,
+) -> Iterator[FileResult]:
+    """
+    Runs the given checks/mods on all python files in paths in-process and returns
+    an iterator over the per-file results, in file order.
+
+    Stopping the iteration early cancels any files not yet being processed.
+
+    Commands are either command names (like ``not_in``) or inspector classes. Files
+    are only written back if ``write`` is set. With ``check_only``, mods only report
+    and count what they would change, without any transformed source. With ``jobs``
+    > 1 (or None for one per CPU), files are processed in that many worker processes.
+    Any further options are made available to the inspectors as their args.
+    """
+    _load_all()
+
+    classes = []
+    for command in commands:
+        cls = (
+            command
+            if isinstance(command, type) and issubclass(command, CodeInspector)
+            else CodeInspectorMeta.lookup(command)
+        )
+        if not cls:
+            raise ValueError(f"No check or mod found for {command}")
+        classes.append(cls)
+
+    defaults = dict(
+        bases=list(paths),
+        before=False,
+        after=False,
+        dryrun=not write or check_only,
+        check_only=check_only,
+        ignore=list(ignore),
+        verbose=False,
+        test=False,
+        shard=None,
+        shard_result=None,
+        merge=False,
+        watch=False,
+        fail_fast=None,
+        order="path",
+        snippet_lines=None,
+        file_timeout=None,
+        files_from=None,
+        null=False,
+    )
+    args = argparse.Namespace(**dict(defaults, **options))
+
+    python_files = list(
+        iter_files(
+            args.bases,
+            args.ignore,
+            files_from=args.files_from,
+            separator=b"\0" if args.null else b"\n",
+        )
+    )
+
+    return _run_codemods(python_files, classes, args, jobs or os.cpu_count() or 1)
+
+
 def batch_runner(
     output: Union[str, None] = "{file}: {count} replacements done",
 ) -> None:
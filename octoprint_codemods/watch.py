@@ -0,0 +1,243 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from .util import CodeCheck, CodeMod, collect_files, get_dispatch, run_file
+
+DEBOUNCE = 0.25
+POLL_INTERVAL = 1.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Watches the bases for changes using inotify (Linux only).
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, bases: Iterable[str]) -> None:
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify not supported")
+
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watches: Dict[int, str] = {}
+        self.overflowed = False
+        for base in bases:
+            if os.path.isdir(base):
+                self._add_tree(base)
+            else:
+                # files are watched via their directory
+                self._add_watch(os.path.dirname(base) or ".")
+
+    def _add_watch(self, path: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def _add_tree(self, base: str) -> List[str]:
+        paths = []
+        for root, _, filenames in os.walk(base):
+            self._add_watch(root)
+            paths += [f"{root}/{filename}" for filename in filenames]
+        return paths
+
+    def wait(self, timeout: Optional[float]) -> Set[str]:
+        """
+        Waits up to timeout seconds (forever if None) for changes and returns the
+        changed paths.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+
+            if wd not in self.watches or not name:
+                continue
+
+            path = f"{self.watches[wd]}/{name}"
+            if mask & IN_ISDIR:
+                # new directory, watch it and everything that's already in it
+                changed.update(self._add_tree(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.add(path)
+
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watches the bases for changes by periodically comparing file stats.
+    """
+
+    def __init__(
+        self, bases: Iterable[str], ignored: List[str], interval: float = POLL_INTERVAL
+    ) -> None:
+        self.bases = list(bases)
+        self.ignored = ignored
+        self.interval = interval
+        self.overflowed = False
+        self.stats = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        stats = {}
+        for base in self.bases:
+            for path in collect_files(base, ignored=self.ignored):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stats[path] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def wait(self, timeout: Optional[float]) -> Set[str]:
+        """
+        Waits up to timeout seconds (forever if None) for changes and returns the
+        changed paths.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(deadline - time.monotonic(), 0))
+            time.sleep(delay)
+
+            stats = self._scan()
+            changed = {
+                path for path, stat in stats.items() if self.stats.get(path) != stat
+            }
+            self.stats = stats
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self) -> None:
+        pass
+
+
+def create_watcher(
+    bases: Iterable[str], ignored: List[str]
+) -> Union[InotifyWatcher, PollingWatcher]:
+    try:
+        return InotifyWatcher(bases)
+    except OSError:
+        return PollingWatcher(bases, ignored)
+
+
+def watch(
+    inspectors: Iterable[Union[CodeMod, CodeCheck]], args: argparse.Namespace, output: str
+) -> None:
+    """
+    Processes all python files under the bases once, then keeps reprocessing
+    those that change until interrupted.
+    """
+    watcher = create_watcher(args.bases, args.ignore)
+
+    def select_files(paths: Iterable[str]) -> List[str]:
+        # changes might be reported for files next to watched files
+        python_files = []
+        for path in sorted(paths):
+            absolute = os.path.abspath(path)
+            for base in args.bases:
+                absolute_base = os.path.abspath(base)
+                if absolute == absolute_base:
+                    python_files += collect_files(base, ignored=args.ignore)
+                    break
+                elif os.path.isdir(base) and absolute.startswith(
+                    absolute_base.rstrip(os.sep) + os.sep
+                ):
+                    python_files += collect_files(path, ignored=args.ignore)
+                    break
+        return python_files
+
+    def process(python_files: Iterable[str]) -> None:
+        for python_file in python_files:
+            run_file(inspectors, python_file, args, output, dispatch=dispatch)
+
+            # don't pick up our own changes
+            try:
+                stat = os.stat(python_file)
+                processed[python_file] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+
+    def all_files() -> List[str]:
+        python_files = []
+        for base in args.bases:
+            python_files += collect_files(base, ignored=args.ignore)
+        return python_files
+
+    # the inspectors stay the same, so their dispatch can be kept around
+    dispatch = get_dispatch(inspectors)
+
+    processed: Dict[str, Tuple[int, int]] = {}
+    try:
+        process(all_files())
+
+        print("Watching for changes, press Ctrl+C to stop")
+        while True:
+            changed = watcher.wait(None)
+
+            # debounce, wait until things calm down
+            while True:
+                more = watcher.wait(DEBOUNCE)
+                if not more:
+                    break
+                changed |= more
+
+            if watcher.overflowed:
+                # we lost events, so just check everything again
+                watcher.overflowed = False
+                changed = set(all_files())
+
+            python_files = []
+            for python_file in select_files(changed):
+                try:
+                    stat = os.stat(python_file)
+                except OSError:
+                    continue
+                if processed.get(python_file) != (stat.st_mtime_ns, stat.st_size):
+                    python_files.append(python_file)
+
+            process(python_files)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        watcher.close()
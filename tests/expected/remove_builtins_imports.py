@@ -0,0 +1,8 @@
+import os
+
+try:
+    pass
+except ImportError:
+    pass
+
+foo = str(os.getcwd())
@@ -0,0 +1,26 @@
+import os
+from past.builtins import basestring
+
+try:
+    from past import utils
+except ImportError:
+    utils = None
+
+if True: import past.builtins; x = 1
+
+from \
+    past.utils import old_div
+
+
+def foo():
+    import past as p
+
+    return p
+
+
+if foo():
+    from past.builtins import (
+        basestring,
+        # comment
+        unicode,
+    )
@@ -0,0 +1,9 @@
+import os
+from builtins import str
+
+try:
+    import builtins
+except ImportError:
+    pass
+
+foo = str(os.getcwd())
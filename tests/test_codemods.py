@@ -1,12 +1,14 @@
 import importlib
+import json
 import os
+import shutil
 
 import pytest
 
 codemods = [
     "not_in",
-    # "remove_builtins_imports",
-    # "detect_past_builtins_imports",
+    "remove_builtins_imports",
+    "detect_past_builtins_imports",
     "remove_float_conversion",
 ]
 
@@ -62,3 +64,560 @@ def test_batch(monkeypatch):
             monkeypatch,
         )
     assert exc.value.code == 0
+
+
+@pytest.mark.parametrize(
+    "codemod",
+    [
+        pytest.param(codemod, id=codemod)
+        for codemod in ("remove_builtins_imports", "detect_past_builtins_imports")
+    ],
+)
+def test_import_header(codemod, capsys, tmp_path):
+    from octoprint_codemods.util import CodeInspectorMeta, process_file
+
+    importlib.import_module("octoprint_codemods." + codemod)
+    cls = CodeInspectorMeta.lookup(codemod)
+    assert cls.IMPORTS_ONLY
+
+    input_file = str(tmp_path / (codemod + ".py"))
+    shutil.copy(_get_files(codemod)[0], input_file)
+
+    results = []
+    for full_parse in (False, True):
+        inspector = cls(None)
+        # requesting the CST dump forces the full parse
+        code = process_file(
+            [inspector], input_file, write_after=full_parse, write_result=False
+        )
+        results.append((code, inspector.count, capsys.readouterr().out))
+
+    assert results[0] == results[1]
+
+
+@pytest.mark.parametrize("check_only", [False, True])
+@pytest.mark.parametrize(
+    "codemod", ["detect_past_builtins_imports", "remove_builtins_imports"]
+)
+def test_import_header_syntax_error(codemod, check_only, tmp_path):
+    from octoprint_codemods import run_codemods
+
+    input_file = tmp_path / "invalid.py"
+    input_file.write_text('from past.builtins import basestring\nprint "hello"\n')
+
+    (result,) = run_codemods([str(input_file)], [codemod], check_only=check_only)
+    assert "failed parse" in result.error
+    assert result.count == 0
+    assert not result.findings
+
+
+def test_shard_files(tmp_path):
+    from octoprint_codemods.util import shard_files
+
+    python_files = []
+    for size in (1, 5, 2, 8, 3, 9, 4, 7, 6):
+        path = tmp_path / f"file_{size}.py"
+        path.write_text("x = 1\n" * size)
+        python_files.append(str(path))
+
+    shards = [shard_files(python_files, index, 3) for index in (1, 2, 3)]
+
+    assert sorted(sum(shards, [])) == sorted(python_files)
+    assert shards == [shard_files(python_files, index, 3) for index in (1, 2, 3)]
+    assert all(shard == sorted(shard, key=python_files.index) for shard in shards)
+
+    loads = [sum(os.path.getsize(path) for path in shard) for shard in shards]
+    assert loads == [16 * 6, 15 * 6, 14 * 6]
+
+
+def _write_shard_result(tmp_path, index, total, files):
+    result_file = tmp_path / f"shard-{index}-of-{total}.json"
+    result_file.write_text(
+        json.dumps(
+            {
+                "shard": [index, total],
+                "count": sum(count for _, count, _ in files),
+                "files": [
+                    {"file": file, "count": count, "output": output}
+                    for file, count, output in files
+                ],
+            }
+        )
+    )
+    return str(result_file)
+
+
+def test_merge_results(tmp_path, capsys):
+    from octoprint_codemods.util import merge_results
+
+    result_files = [
+        _write_shard_result(tmp_path, 1, 2, [("b.py", 2, "b.py: 2 replacements done\n")]),
+        _write_shard_result(tmp_path, 2, 2, [("a.py", 1, "a.py: 1\n")]),
+    ]
+
+    assert merge_results(result_files) == 3
+    assert capsys.readouterr().out == "a.py: 1\nb.py: 2 replacements done\n"
+
+
+def test_merge_results_incomplete(tmp_path, capsys):
+    from octoprint_codemods.util import merge_results
+
+    first = _write_shard_result(tmp_path, 1, 2, [("b.py", 2, "b.py: 2\n")])
+    second = _write_shard_result(tmp_path, 2, 2, [("a.py", 0, "")])
+    other = _write_shard_result(tmp_path, 2, 3, [("c.py", 0, "")])
+
+    # missing shard
+    assert merge_results([second]) == -1
+    assert "Missing results for shard(s) 1/2" in capsys.readouterr().out
+
+    # duplicate shard, only counted once
+    assert merge_results([first, first, second]) == -1
+    output = capsys.readouterr().out
+    assert "contains shard 1/2 again" in output
+    assert output.count("b.py: 2") == 1
+
+    # different number of shards
+    assert merge_results([first, other]) == -1
+    assert "is from a run with 3 shards, not 2" in capsys.readouterr().out
+
+
+def test_polling_watcher(tmp_path):
+    from octoprint_codemods.watch import PollingWatcher
+
+    (tmp_path / "unchanged.py").write_text("x = 1\n")
+    changed = tmp_path / "changed.py"
+    changed.write_text("x = 1\n")
+
+    watcher = PollingWatcher([str(tmp_path)], [], interval=0.01)
+    assert watcher.wait(0.05) == set()
+
+    changed.write_text("x = 2\n")
+    (tmp_path / "new.py").write_text("x = 3\n")
+    (tmp_path / "new.txt").write_text("x = 3\n")
+    assert watcher.wait(0.05) == {f"{tmp_path}/changed.py", f"{tmp_path}/new.py"}
+
+
+@pytest.mark.parametrize(
+    "jobs", [pytest.param(1, id="serial"), pytest.param(2, id="jobs")]
+)
+def test_run_codemods(jobs):
+    from octoprint_codemods import run_codemods
+
+    input_files = [_get_files(codemod)[0] for codemod in codemods]
+    results = list(run_codemods(input_files, codemods, jobs=jobs))
+
+    assert [result.filename for result in results] == input_files
+    for codemod, result in zip(codemods, results):
+        with open(_get_files(codemod)[1], "r") as f:
+            assert result.source == f.read()
+        assert result.count == result.counts[codemod] > 0
+        assert result.error is None
+
+
+@pytest.mark.parametrize(
+    "jobs", [pytest.param(1, id="serial"), pytest.param(2, id="jobs")]
+)
+def test_run_codemods_cst_dumps(jobs, tmp_path):
+    from octoprint_codemods import run_codemods
+
+    input_file, _ = _get_files("not_in")
+    input_files = [str(tmp_path / name) for name in ("a.py", "b.py")]
+    for name in input_files:
+        shutil.copy(input_file, name)
+
+    list(run_codemods(input_files, ["not_in"], jobs=jobs, before=True, after=True))
+
+    for name in input_files:
+        assert os.path.exists(name + ".cst.before")
+        assert os.path.exists(name + ".cst.after")
+
+
+def test_run_codemods_parse_error(tmp_path):
+    from octoprint_codemods import run_codemods
+
+    input_file, _ = _get_files("not_in")
+    for name in ("a.py", "c.py"):
+        shutil.copy(input_file, tmp_path / name)
+    (tmp_path / "b.py").write_text("def (:\n")
+
+    results = {
+        os.path.basename(result.filename): result
+        for result in run_codemods(
+            [str(tmp_path / name) for name in ("a.py", "b.py", "c.py")], ["not_in"]
+        )
+    }
+    assert {name: result.count for name, result in results.items()} == {
+        "a.py": 1,
+        "b.py": 0,
+        "c.py": 1,
+    }
+    assert "failed parse" in results["b.py"].error
+    assert not results["b.py"].findings
+
+
+def test_run_codemods_unknown_command():
+    from octoprint_codemods import run_codemods
+
+    with pytest.raises(ValueError):
+        run_codemods([], ["does_not_exist"])
+
+
+def test_run_codemods_releases_inspectors():
+    import gc
+    import weakref
+
+    from octoprint_codemods import run_codemods
+    from octoprint_codemods.not_in import NotIn
+
+    instances = weakref.WeakSet()
+
+    class TrackedNotIn(NotIn):
+        def __init__(self, args):
+            super().__init__(args)
+            instances.add(self)
+
+    input_file, _ = _get_files("not_in")
+    for _ in range(2):
+        (result,) = run_codemods([input_file], [TrackedNotIn])
+        assert result.count == 1
+
+    # nothing keeps the inspectors and their last file's tree around
+    gc.collect()
+    assert len(instances) == 0
+
+
+def test_duplicate_files(tmp_path, monkeypatch, capsys):
+    input_file, expected_file = _get_files("batch")
+    for name in ("a.py", "b.py"):
+        shutil.copy(input_file, str(tmp_path / name))
+
+    argv = ["codemod_batch"]
+    for codemod in codemods:
+        argv += ["--check", codemod]
+    argv += [str(tmp_path / "a.py"), str(tmp_path / "b.py")]
+    monkeypatch.setattr("sys.argv", argv)
+
+    module = importlib.import_module("octoprint_codemods.batch")
+    with pytest.raises(SystemExit) as exc:
+        getattr(module, "main")()
+    assert exc.value.code == 16
+
+    with open(expected_file, "r") as f:
+        expected = f.read()
+    for name in ("a.py", "b.py"):
+        assert (tmp_path / name).read_text() == expected
+
+    output = capsys.readouterr().out.replace(str(tmp_path).replace("\\", "/"), "")
+    assert output.count("/a.py") == output.count("/b.py") == 9
+    first, second = output.split("/a.py: 8 replacements done\n")
+    assert first.replace("/a.py", "/b.py") + "/b.py: 8 replacements done\n" == second
+
+
+def test_duplicate_files_source(tmp_path, monkeypatch):
+    from octoprint_codemods import util
+
+    input_file, _ = _get_files("not_in")
+    for name in ("a.py", "b.py"):
+        shutil.copy(input_file, str(tmp_path / name))
+    (tmp_path / "c.py").write_text("x = 1\n")
+    (tmp_path / "d.py").write_text("x = 1\n")
+
+    applied = {}
+    apply_result = util.apply_result
+
+    def record(result, filename, write_result=True):
+        applied[os.path.basename(filename)] = result.source
+        return apply_result(result, filename, write_result=write_result)
+
+    monkeypatch.setattr(util, "apply_result", record)
+    monkeypatch.setattr(
+        "sys.argv",
+        ["codemod_not_in"]
+        + [str(tmp_path / name) for name in ("a.py", "b.py", "c.py", "d.py")],
+    )
+    with pytest.raises(SystemExit):
+        importlib.import_module("octoprint_codemods.not_in").main()
+
+    # only modified results keep their source around for writing back duplicates
+    assert applied["b.py"] is not None
+    assert applied["d.py"] is None
+    assert (tmp_path / "d.py").read_text() == "x = 1\n"
+
+
+def test_check_only():
+    from octoprint_codemods import run_codemods
+
+    input_files = [_get_files(codemod)[0] for codemod in codemods + ["batch"]]
+
+    def summary(results):
+        return [
+            (
+                result.filename,
+                result.counts,
+                result.modified,
+                [finding.message for finding in result.findings],
+            )
+            for result in results
+        ]
+
+    transformed = list(run_codemods(input_files, codemods))
+    checked = list(run_codemods(input_files, codemods, check_only=True))
+
+    assert summary(checked) == summary(transformed)
+    assert all(result.source is None for result in checked)
+
+
+def test_fail_fast(tmp_path, monkeypatch, capsys):
+    input_file, _ = _get_files("not_in")
+    for index, name in enumerate(("old.py", "new.py")):
+        path = str(tmp_path / name)
+        shutil.copy(input_file, path)
+        os.utime(path, (1000000000 + index, 1000000000 + index))
+
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "codemod_not_in",
+            "--dryrun",
+            "--fail-fast",
+            "--order",
+            "mtime",
+            str(tmp_path),
+        ],
+    )
+    module = importlib.import_module("octoprint_codemods.not_in")
+    with pytest.raises(SystemExit) as exc:
+        getattr(module, "main")()
+    assert exc.value.code == 1
+
+    output = capsys.readouterr().out
+    assert "new.py: 1 replacements done" in output
+    assert "old.py" not in output
+
+
+def test_snippets(tmp_path):
+    import libcst as cst
+    import libcst.matchers as m
+
+    from octoprint_codemods import run_codemods
+
+    source = (
+        "x = (not a\n"
+        "in b)\n"
+        "def foo(a, b):\n"
+        "    if (not a in b):\n"
+        "        return (not a\n"
+        "                in b)\n"
+    )
+    input_file = tmp_path / "snippets.py"
+    input_file.write_text(source)
+
+    def snippets(**options):
+        (result,) = run_codemods([str(input_file)], ["not_in"], **options)
+        return [finding.code for finding in result.findings]
+
+    # same as what libcst generates for the nodes
+    module = cst.parse_module(source)
+    expected = [
+        module.code_for_node(node)
+        for node in m.findall(module, m.UnaryOperation(operator=m.Not()))
+    ]
+    assert expected == [
+        "(not a\nin b)",
+        "(not a in b)",
+        "(not a\n        in b)",
+    ]
+    assert snippets() == expected
+    assert snippets(snippet_lines=1) == ["(not a\n...", "(not a in b)", "(not a\n..."]
+
+
+def test_compile_rules():
+    import argparse
+
+    import libcst as cst
+    import libcst.matchers as m
+
+    from octoprint_codemods.not_in import NotIn
+    from octoprint_codemods.util import (
+        CodeMod,
+        CodeRule,
+        _visit_tree,
+        compile_rules,
+        get_dispatch,
+    )
+
+    class NotIs(CodeRule):
+        TOKEN = " is "
+        PATTERN = m.UnaryOperation(
+            operator=m.Not(),
+            expression=m.Comparison(comparisons=[m.ComparisonTarget(operator=m.Is())]),
+        )
+
+        def replace(self, original_node, updated_node):
+            comparison = updated_node.expression
+            return comparison.with_changes(
+                comparisons=[comparison.comparisons[0].with_changes(operator=cst.IsNot())]
+            )
+
+    args = argparse.Namespace()
+    rules = [NotIn(args), NotIs(args)]
+    assert list(compile_rules(rules)) == ["leave_UnaryOperation"]
+
+    def transform(source):
+        wrapper = cst.MetadataWrapper(cst.parse_module(source))
+        return _visit_tree(rules, "test.py", wrapper, source, []).code
+
+    assert transform("a = not b in c\nd = not e is None\n") == (
+        "a = b not in c\nd = e is not None\n"
+    )
+    assert [rule.count for rule in rules] == [1, 1]
+
+    # the token guard disables rules for files that can't contain a match
+    assert transform("a = not b in c\n") == "a = b not in c\n"
+    assert not rules[1].enabled
+    assert [rule.count for rule in rules] == [1, 0]
+
+    # overlapping rules, only the first matching one applies, also when only checking
+    class AlsoNotIn(NotIn):
+        pass
+
+    rules = [NotIn(args), AlsoNotIn(args)]
+    source = "a = not b in c\n"
+    for check_only in (False, True):
+        wrapper = cst.MetadataWrapper(cst.parse_module(source))
+        _visit_tree(rules, "test.py", wrapper, source, [], check_only=check_only)
+        assert [rule.count for rule in rules] == [1, 0]
+
+    # compiled rules keep their place among the other mods
+    class Other(CodeMod):
+        def leave_UnaryOperation(self, original_node, updated_node):
+            return updated_node
+
+    other = Other(args)
+    _, methods = get_dispatch([other, NotIn(args), AlsoNotIn(args)])
+    assert len(methods["leave_UnaryOperation"]) == 2
+    assert methods["leave_UnaryOperation"][0] == other.leave_UnaryOperation
+    _, methods = get_dispatch([NotIn(args), other, AlsoNotIn(args)])
+    assert len(methods["leave_UnaryOperation"]) == 2
+    assert methods["leave_UnaryOperation"][1] == other.leave_UnaryOperation
+
+    class NoReplace(CodeRule):
+        PATTERN = m.Name()
+
+    with pytest.raises(TypeError):
+        NoReplace(args)
+
+
+def test_file_timeout(tmp_path, monkeypatch, capsys):
+    import time
+
+    from octoprint_codemods.util import CodeCheck, merge_results, runner
+
+    class Pathological(CodeCheck):
+        DESCRIPTION = "Hangs or crashes on some names"
+
+        def visit_Name(self, node):
+            if node.value == "hang":
+                time.sleep(60)
+            elif node.value == "crash":
+                os._exit(3)
+            elif node.value == "recurse":
+                raise RecursionError("maximum recursion depth exceeded")
+
+    for name in ("crash", "hang", "ok", "recurse"):
+        (tmp_path / f"{name}.py").write_text(f"{name}\n")
+
+    shard_result = str(tmp_path / "shard.json")
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "codemod_test",
+            "--verbose",
+            "--file-timeout",
+            "1",
+            "--shard",
+            "1/1",
+            "--shard-result",
+            shard_result,
+            str(tmp_path),
+        ],
+    )
+    with pytest.raises(SystemExit) as exc:
+        runner(Pathological)
+    assert exc.value.code == -1
+
+    output = capsys.readouterr().out
+    assert "ok.py: 0 replacements done" in output
+    summary = dict(
+        line.strip().split(": ", 1)
+        for line in output[output.index("Skipped 3 file(s):") :].splitlines()[1:]
+    )
+    assert sorted(summary) == [
+        str(tmp_path / f"{name}.py") for name in ("crash", "hang", "recurse")
+    ]
+    assert summary[str(tmp_path / "crash.py")].startswith(
+        "worker crashed with exit code 3"
+    )
+    assert summary[str(tmp_path / "hang.py")] == "timed out after 1s"
+    assert summary[str(tmp_path / "recurse.py")] == (
+        "RecursionError: maximum recursion depth exceeded"
+    )
+
+    # skipped files are carried over into merged shard results
+    with open(shard_result) as f:
+        assert len(json.load(f)["skipped"]) == 3
+    assert merge_results([shard_result]) == -1
+    output = capsys.readouterr().out
+    assert "Skipped 3 file(s):" in output
+    assert "hang.py: timed out after 1s" in output
+
+
+def test_files_from(tmp_path, monkeypatch, capsys):
+    import io
+
+    input_file, _ = _get_files("not_in")
+    for name in ("a.py", "b.py", "ignored/c.py", "sub/d.py"):
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        shutil.copy(input_file, tmp_path / name)
+    (tmp_path / "e.txt").write_text("not a in b\n")
+
+    paths = ["a.py", "b.py", "a.py", "./b.py", "ignored/c.py", "sub", "e.txt"]
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        "sys.stdin", io.TextIOWrapper(io.BytesIO("\0".join(paths).encode()))
+    )
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "codemod_not_in",
+            "--dryrun",
+            "--ignore",
+            "ignored/",
+            "--files-from",
+            "-",
+            "-z",
+        ],
+    )
+    module = importlib.import_module("octoprint_codemods.not_in")
+    with pytest.raises(SystemExit) as exc:
+        getattr(module, "main")()
+    assert exc.value.code == 3
+
+    output = capsys.readouterr().out
+    assert [line for line in output.splitlines() if "replacements done" in line] == [
+        "a.py: 1 replacements done",
+        "b.py: 1 replacements done",
+        "sub/d.py: 1 replacements done",
+    ]
+
+
+def test_read_file_list():
+    import io
+
+    from octoprint_codemods.util import read_file_list
+
+    stream = io.BytesIO(b"a.py\r\nb c.py\n\nd.py")
+    assert list(read_file_list(stream)) == ["a.py", "b c.py", "d.py"]
+
+    stream = io.BytesIO(b"a\nb.py\0c.py\0")
+    assert list(read_file_list(stream, b"\0")) == ["a\nb.py", "c.py"]